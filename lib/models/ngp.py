@@ -2,8 +2,9 @@
 Copyright (c) 2022 Ruilong Li, UC Berkeley.
 """
 
-from typing import Callable, List, Union
-import numpy as np
+import math
+from collections import OrderedDict
+from typing import Callable, List, Optional, Union
 import torch
 from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd
@@ -25,19 +26,50 @@ class _TruncExp(Function):  # pylint: disable=abstract-method
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, x):  # pylint: disable=arguments-differ
-        ctx.save_for_backward(x)
-        return torch.exp(x)
+        y = torch.exp(x)
+        if ctx.needs_input_grad[0]:
+            # exp is monotonic, so exp(min(x, 15)) == min(exp(x), e^15) and
+            # backward is a plain multiply instead of clamp + exp again
+            ctx.save_for_backward(torch.clamp(y, max=math.exp(15)))
+        return y
 
     @staticmethod
     @custom_bwd
     def backward(ctx, g):  # pylint: disable=arguments-differ
-        x = ctx.saved_tensors[0]
-        return g * torch.exp(torch.clamp(x, max=15))
+        return g * ctx.saved_tensors[0]
 
 
 trunc_exp = _TruncExp.apply
 
 
+class _DensityAct(torch.nn.Module):
+    """Default density activation, trunc_exp(x - 1)."""
+
+    def forward(self, x):
+        return trunc_exp(x - 1.0)
+
+
+def _per_level_scale(
+    aabb: torch.Tensor,
+    base_res: int = 16,
+    max_res: int = 2048,
+    n_levels: int = 16,
+) -> float:
+    # growth factor taking the hash grid from base_res to max_res * |aabb|
+    return (max_res * float(aabb[0].abs()) / base_res) ** (1.0 / (n_levels - 1))
+
+
+def _maybe_compile(fn, **kwargs):
+    # fall back to eager on torch < 2.0 or on platforms where the
+    # installed build refuses to compile
+    if not hasattr(torch, "compile"):
+        return fn
+    try:
+        return torch.compile(fn, **kwargs)
+    except RuntimeError:
+        return fn
+
+
 def contract_to_unisphere(
     x: torch.Tensor,
     aabb: torch.Tensor,
@@ -45,22 +77,56 @@ def contract_to_unisphere(
     derivative: bool = False,
 ):
     aabb_min, aabb_max = torch.split(aabb, 3, dim=-1)
-    x = (x - aabb_min) / (aabb_max - aabb_min)
-    x = x * 2 - 1  # aabb is at [-1, 1]
+    x = (x - aabb_min).mul_(1.0 / (aabb_max - aabb_min))
+    return _contract_normalized(x, eps=eps, derivative=derivative)
+
+
+def _contract_normalized(
+    x: torch.Tensor,
+    eps: float = 1e-6,
+    derivative: bool = False,
+):
+    # same as contract_to_unisphere for x already mapped to [0, 1] by the aabb
+    # in-place chains below save allocations in eager mode; torch.compile
+    # fuses them either way
+    x = (x * 2).sub_(1)  # aabb is at [-1, 1]
     mag = x.norm(dim=-1, keepdim=True)
-    mask = mag.squeeze(-1) > 1
+    # Clamping |x| to 1 leaves points inside the unit sphere untouched (and
+    # their derivative at 1) without boolean indexing, so the contraction is
+    # purely elementwise and autograd-safe.
+    mag = torch.clamp(mag, min=1.0)
+
+    # per-row factors are computed on [N, 1] so each branch makes a single
+    # pass over the [N, 3] points
+    inv_mag = 1.0 / mag
+    scale = (2 - inv_mag) * inv_mag  # (2 * mag - 1) / mag**2
 
     if derivative:
-        dev = (2 * mag - 1) / mag**2 + 2 * x**2 * (
-            1 / mag**3 - (2 * mag - 1) / mag**4
-        )
-        dev[~mask] = 1.0
-        dev = torch.clamp(dev, min=eps)
-        return dev
+        # 1 / mag**3 - (2 * mag - 1) / mag**4 == inv_mag**3 * (inv_mag - 1)
+        dev = scale + 2 * x**2 * (inv_mag**3 * (inv_mag - 1))
+        return dev.clamp_(min=eps)
     else:
-        x[mask] = (2 - 1 / mag[mask]) * (x[mask] / mag[mask])
-        x = x / 4 + 0.5  # [-inf, inf] is at [0, 1]
-        return x
+        x = x * scale
+        return x.mul_(0.25).add_(0.5)  # [-inf, inf] is at [0, 1]
+
+
+# compiled on first call into a single fused elementwise kernel;
+# query_density calls _contract_normalized directly, which is only fused
+# when the whole forward is compiled (compile_forward)
+contract_to_unisphere = _maybe_compile(contract_to_unisphere, dynamic=True)
+
+
+def _select_density(x: torch.Tensor, density: torch.Tensor):
+    # zero the density of samples outside the normalized aabb; unlike a
+    # multiply by the selector, where() keeps inf * 0 from turning into nan.
+    # Eager mode still materializes the mask; the comparisons, reduction and
+    # gating only fuse into one kernel when compile_forward is set
+    inside = ((x > 0.0) & (x < 1.0)).all(dim=-1, keepdim=True)
+    return torch.where(inside, density, 0.0)
+
+
+# number of uncaptured input shapes remembered for CUDA graph capture
+_MAX_SEEN_SHAPES = 64
 
 
 class NGPradianceField(torch.nn.Module):
@@ -72,25 +138,61 @@ class NGPradianceField(torch.nn.Module):
         num_dim: int = 3,
         use_viewdirs: bool = False,
         cond_type: str = "none",
-        density_activation: Callable = lambda x: trunc_exp(x - 1),
+        density_activation: Optional[Callable] = None,
         unbounded: bool = False,
         geo_feat_dim: int = 15,
         n_levels: int = 16,
         log2_hashmap_size: int = 19,
+        enable_cuda_graph: bool = False,
+        max_cuda_graphs: int = 4,
+        io_dtype: Optional[torch.dtype] = None,
+        compile_forward: bool = False,
     ) -> None:
         super().__init__()
         if not isinstance(aabb, torch.Tensor):
             aabb = torch.tensor(aabb, dtype=torch.float32)
         self.register_buffer("aabb", aabb)
         # self.aabb = aabb
+        # cache the normalization terms so forward passes skip the split/divide
+        aabb_min, aabb_max = torch.split(aabb, num_dim, dim=-1)
+        self.register_buffer("aabb_min", aabb_min.contiguous(), persistent=False)
+        self.register_buffer(
+            "inv_extent", (1.0 / (aabb_max - aabb_min)).contiguous(), persistent=False
+        )
         self.num_dim = num_dim
         self.use_viewdirs = use_viewdirs
+        if density_activation is None:
+            density_activation = _DensityAct()
         self.density_activation = density_activation
         self.unbounded = unbounded
+        # dtype of the returned density/rgb, defaults to the input dtype;
+        # set to torch.float16 to hand half outputs to AMP pipelines
+        self.io_dtype = io_dtype
+        # gradient-free forward passes are replayed from CUDA graphs,
+        # captured once per input shape that shows up more than once; each
+        # graph pins its own memory pool, so only the most recently used
+        # max_cuda_graphs shapes are kept
+        self.enable_cuda_graph = enable_cuda_graph
+        self.max_cuda_graphs = max_cuda_graphs
+        self._graph_cache = OrderedDict()
+        self._graph_seen = OrderedDict()
+        # side stream shared by all warm-ups and captures, created on first use
+        self._graph_stream = None
+        # compile the glue around the tcnn calls (normalization, contraction,
+        # density gating) into fused kernels; dynamic=None lets dynamo mark
+        # the varying ray/sample count dynamic after the first recompile.
+        # CUDA graphs are left to enable_cuda_graph so the two do not nest.
+        # The unbound _forward_impl is compiled so no bound method of self
+        # ends up in self.__dict__
+        self._compiled_forward = (
+            _maybe_compile(type(self)._forward_impl, dynamic=None)
+            if compile_forward
+            else type(self)._forward_impl
+        )
 
         self.geo_feat_dim = geo_feat_dim
         # per_level_scale = 1.4472692012786865
-        per_level_scale = float(np.exp2(np.log2(2048 * aabb[0].abs() / 16.) / (16. - 1.)))
+        per_level_scale = _per_level_scale(aabb)
 
         if self.use_viewdirs:
             if cond_type == "neck_pose":
@@ -161,6 +263,13 @@ class NGPradianceField(torch.nn.Module):
                     "n_hidden_layers": 2,
                 },
             )
+        # cond_type and use_viewdirs are fixed, so pick the rgb path once;
+        # stored as a plain function, not a bound method, see NGPNet
+        self._qrgb = {
+            "none": type(self)._qrgb_no_view,
+            "neck_pose": type(self)._qrgb_neck,
+            "posed_verts": type(self)._qrgb_posed,
+        }[cond_type if use_viewdirs else "none"]
 
     def query_density(self, x, return_feat: bool = False):
         '''
@@ -168,50 +277,54 @@ class NGPradianceField(torch.nn.Module):
         y range: [0.4, 0.7]
         z range: [-0.5, 0.3]
         '''
+        # aabb = self.aabb.to(x.device)
+        x = (x - self.aabb_min).mul_(self.inv_extent)
         if self.unbounded:
-            x = contract_to_unisphere(x, self.aabb)
-        else:
-            # aabb = self.aabb.to(x.device)
-            aabb_min, aabb_max = torch.split(self.aabb, self.num_dim, dim=-1)
-            x = (x - aabb_min) / (aabb_max - aabb_min)
-        selector = ((x > 0.0) & (x < 1.0)).all(dim=-1)
-        x = (
+            x = _contract_normalized(x)
+        out = (
             self.mlp_base(x.view(-1, self.num_dim))
-            .view(list(x.shape[:-1]) + [1 + self.geo_feat_dim])
+            .view(*x.shape[:-1], 1 + self.geo_feat_dim)
             .to(x)
         )
         density_before_activation, base_mlp_out = torch.split(
-            x, [1, self.geo_feat_dim], dim=-1
-        )
-        density = (
-            self.density_activation(density_before_activation)
-            * selector[..., None]
+            out, [1, self.geo_feat_dim], dim=-1
         )
+        # the activation runs in at least fp32 so trunc_exp keeps its
+        # overflow guard; only its result is cast to io_dtype
+        if density_before_activation.dtype in (torch.float16, torch.bfloat16):
+            density_before_activation = density_before_activation.float()
+        density = _select_density(
+            x, self.density_activation(density_before_activation)
+        ).to(self.io_dtype or x.dtype)
         if return_feat:
             return density, base_mlp_out
         else:
             return density
 
     def _query_rgb(self, dir, embedding):
+        return self._qrgb(self, dir, embedding)
+
+    def _qrgb_no_view(self, dir, embedding):
+        h = embedding.view(-1, self.geo_feat_dim)
+        rgb = self.mlp_head(h).view(*embedding.shape[:-1], 3)
+        return rgb
+
+    def _qrgb_neck(self, dir, embedding):
         # tcnn requires directions in the range [0, 1]
-        if self.use_viewdirs:
-            if self.cond_type == "neck_pose":
-                dir = (dir + 1.0) / 2.0
-            elif self.cond_type == "posed_verts":
-                aabb_min, aabb_max = torch.split(self.aabb, self.num_dim, dim=-1)
-                dir = (dir - aabb_min) / (aabb_max - aabb_min)
-            d = self.direction_encoding(dir.view(-1, dir.shape[-1]))
-            h = torch.cat([d, embedding.view(-1, self.geo_feat_dim)], dim=-1)
-        else:
-            h = embedding.view(-1, self.geo_feat_dim)
-        rgb = (
-            self.mlp_head(h)
-            .view(list(embedding.shape[:-1]) + [3])
-            .to(embedding)
-        )
+        return self._qrgb_view((dir + 1.0) / 2.0, embedding)
+
+    def _qrgb_posed(self, dir, embedding):
+        # tcnn requires directions in the range [0, 1]
+        dir = (dir - self.aabb_min).mul_(self.inv_extent)
+        return self._qrgb_view(dir, embedding)
+
+    def _qrgb_view(self, dir, embedding):
+        d = self.direction_encoding(dir.view(-1, dir.shape[-1]))
+        h = torch.cat([d, embedding.view(-1, self.geo_feat_dim)], dim=-1)
+        rgb = self.mlp_head(h).view(*embedding.shape[:-1], 3)
         return rgb
 
-    def forward(
+    def _forward_impl(
         self,
         positions: torch.Tensor,
         directions: torch.Tensor = None,
@@ -225,7 +338,95 @@ class NGPradianceField(torch.nn.Module):
         else:
             density, embedding = self.query_density(positions, return_feat=True)
             rgb = self._query_rgb(directions, embedding=embedding)
-        return rgb, density
+        return rgb.to(density), density
+
+    @torch.no_grad()
+    def _update_aabb_terms(self):
+        # refresh the cached normalization terms after self.aabb changed;
+        # written in place so captured CUDA graphs stay valid
+        aabb_min, aabb_max = torch.split(self.aabb, self.num_dim, dim=-1)
+        self.aabb_min.copy_(aabb_min)
+        self.inv_extent.copy_(1.0 / (aabb_max - aabb_min))
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # aabb_min / inv_extent are not persistent, derive them from the
+        # loaded aabb
+        super()._load_from_state_dict(*args, **kwargs)
+        self._update_aabb_terms()
+
+    def _apply(self, fn, *args, **kwargs):
+        # captured graphs hold raw pointers to the current params and
+        # buffers, which .to() / .half() / .cuda() reallocate
+        self._graph_cache.clear()
+        self._graph_seen.clear()
+        self._graph_stream = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def _capture_graph(self, positions, directions):
+        static_pos = positions.clone()
+        static_dir = directions.clone() if directions is not None else None
+        # warm up on a side stream so lazy allocations are not captured, and
+        # capture on that same stream
+        if self._graph_stream is None:
+            self._graph_stream = torch.cuda.Stream(device=positions.device)
+        stream = self._graph_stream
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._forward_impl(static_pos, static_dir)
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, stream=stream):
+            static_out = self._forward_impl(static_pos, static_dir)
+        return graph, static_pos, static_dir, static_out
+
+    def _graphed_forward(self, positions, directions):
+        # everything that changes the captured kernels or output dtypes
+        key = (
+            positions.shape,
+            directions.shape if directions is not None else None,
+            positions.dtype,
+            directions.dtype if directions is not None else None,
+            positions.device,
+            torch.is_autocast_enabled(),
+            self.io_dtype,
+        )
+        if key not in self._graph_cache:
+            if key not in self._graph_seen:
+                # one-off shapes are not worth the capture cost
+                self._graph_seen[key] = None
+                if len(self._graph_seen) > _MAX_SEEN_SHAPES:
+                    self._graph_seen.popitem(last=False)
+                return self._forward_impl(positions, directions)
+            if self.max_cuda_graphs <= 0:
+                return self._forward_impl(positions, directions)
+            if len(self._graph_cache) >= self.max_cuda_graphs:
+                self._graph_cache.popitem(last=False)
+            with torch.inference_mode():
+                self._graph_cache[key] = self._capture_graph(positions, directions)
+        self._graph_cache.move_to_end(key)
+        graph, static_pos, static_dir, static_out = self._graph_cache[key]
+        with torch.inference_mode():
+            static_pos.copy_(positions)
+            if static_dir is not None:
+                static_dir.copy_(directions)
+            graph.replay()
+        # clone outside inference mode so callers get regular tensors
+        rgb, density = static_out
+        return rgb.clone(), density.clone()
+
+    def forward(
+        self,
+        positions: torch.Tensor,
+        directions: torch.Tensor = None,
+    ):
+        if (
+            self.enable_cuda_graph
+            and positions.is_cuda
+            and not torch.is_grad_enabled()
+        ):
+            return self._graphed_forward(positions, directions)
+        return self._compiled_forward(self, positions, directions)
 
 
 class NGPNet(torch.nn.Module):
@@ -246,42 +447,56 @@ class NGPNet(torch.nn.Module):
         if not isinstance(aabb, torch.Tensor):
             aabb = torch.tensor(aabb, dtype=torch.float32)
         self.register_buffer("aabb", aabb)
+        aabb_min, aabb_max = torch.split(aabb, input_dim, dim=-1)
+        self.register_buffer("aabb_min", aabb_min.contiguous(), persistent=False)
+        self.register_buffer(
+            "inv_extent", (1.0 / (aabb_max - aabb_min)).contiguous(), persistent=False
+        )
 
         self.input_dim = input_dim
         self.output_dim = output_dim
         self.last_op = last_op
         self.scale = scale
         self.cond_dim = cond_dim
+        # concat buffer reused by gradient-free calls, keyed by shape
+        self._buf = {}
 
-        per_level_scale = float(np.exp2(np.log2(2048 * aabb[0].abs() / 16.) / (16. - 1.)))
+        per_level_scale = _per_level_scale(aabb)
 
-        self.encoder = tcnn.Encoding(
-            n_input_dims=input_dim,
-            encoding_config={
-                "otype": "HashGrid",
-                "n_levels": n_levels,
-                "n_features_per_level": 2,
-                "log2_hashmap_size": log2_hashmap_size,
-                "base_resolution": 16,
-                "per_level_scale": per_level_scale,
-            },
-            )
+        encoding_config = {
+            "otype": "HashGrid",
+            "n_levels": n_levels,
+            "n_features_per_level": 2,
+            "log2_hashmap_size": log2_hashmap_size,
+            "base_resolution": 16,
+            "per_level_scale": per_level_scale,
+        }
         if cond_dim > 0:
-            self.cond_encoder = tcnn.Encoding(
-                n_input_dims=cond_dim,
+            # encode [x, cond] in one launch instead of two encoders + concat
+            self.joint_encoder = tcnn.Encoding(
+                n_input_dims=input_dim + cond_dim,
                 encoding_config={
-                # "otype": "SphericalHarmonics",
-                # "degree": 4,
-                "otype": "HashGrid",
-                "n_levels": n_levels//2,
-                "n_features_per_level": 2,
-                "log2_hashmap_size": log2_hashmap_size//2,
-                "base_resolution": 16,
-                "per_level_scale": per_level_scale,
-            },
+                    "otype": "Composite",
+                    "nested": [
+                        {**encoding_config, "n_dims_to_encode": input_dim},
+                        {
+                            # "otype": "SphericalHarmonics",
+                            # "degree": 4,
+                            **encoding_config,
+                            "n_dims_to_encode": cond_dim,
+                            "n_levels": n_levels//2,
+                            "log2_hashmap_size": log2_hashmap_size//2,
+                        },
+                    ],
+                },
+            )
+        else:
+            self.encoder = tcnn.Encoding(
+                n_input_dims=input_dim,
+                encoding_config=encoding_config,
             )
         self.mlp = tcnn.Network(
-            n_input_dims=self.encoder.n_output_dims + self.cond_encoder.n_output_dims if cond_dim > 0 else self.encoder.n_output_dims,
+            n_input_dims=self.joint_encoder.n_output_dims if cond_dim > 0 else self.encoder.n_output_dims,
             n_output_dims=output_dim,
             network_config={
                 "otype": "FullyFusedMLP",
@@ -291,6 +506,25 @@ class NGPNet(torch.nn.Module):
                 "n_hidden_layers": 1,
             },
         )
+        # pick the cond / no-cond path once instead of branching every call;
+        # the plain function is kept rather than a bound method, so copies
+        # such as DataParallel replicas run it on themselves
+        self._forward = (
+            type(self)._fwd_cond if cond_dim > 0 else type(self)._fwd_no_cond
+        )
+
+    @torch.no_grad()
+    def _update_aabb_terms(self):
+        # refresh the cached normalization terms after self.aabb changed
+        aabb_min, aabb_max = torch.split(self.aabb, self.input_dim, dim=-1)
+        self.aabb_min.copy_(aabb_min)
+        self.inv_extent.copy_(1.0 / (aabb_max - aabb_min))
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # aabb_min / inv_extent are not persistent, derive them from the
+        # loaded aabb
+        super()._load_from_state_dict(*args, **kwargs)
+        self._update_aabb_terms()
 
     def forward(self, x, cond=None):
         '''
@@ -298,15 +532,41 @@ class NGPNet(torch.nn.Module):
         y range: [0.4, 0.7]
         z range: [-0.5, 0.3]
         '''
-        aabb_min, aabb_max = torch.split(self.aabb, self.input_dim, dim=-1)
-        x = (x - aabb_min) / (aabb_max - aabb_min)
-        # selector = ((x > 0.0) & (x < 1.0)).all(dim=-1)
-        x_enc = self.encoder(x.view(-1, self.input_dim))
-        if cond is not None and self.cond_dim > 0:
-            cond = (cond - aabb_min) / (aabb_max - aabb_min)
-            cond_enc = self.cond_encoder(cond.view(-1, cond.shape[-1]))
-            x_enc = torch.cat([x_enc, cond_enc], dim=-1)
-        x = self.mlp(x_enc).view(list(x.shape[:-1]) + [self.output_dim]).to(x)
+        return self._forward(self, x, cond)
+
+    def _decode(self, x_enc, x):
+        x = self.mlp(x_enc).view(*x.shape[:-1], self.output_dim).to(x)
         x = self.last_op(x)*self.scale
         return x
 
+    def _fwd_no_cond(self, x, cond=None):
+        x = (x - self.aabb_min).mul_(self.inv_extent)
+        # selector = ((x > 0.0) & (x < 1.0)).all(dim=-1)
+        x_enc = self.encoder(x.view(-1, self.input_dim))
+        return self._decode(x_enc, x)
+
+    def _fwd_cond(self, x, cond):
+        x = (x - self.aabb_min).mul_(self.inv_extent)
+        cond = (cond - self.aabb_min).mul_(self.inv_extent)
+        inp = self._cat([x.view(-1, self.input_dim), cond.view(-1, self.cond_dim)])
+        x_enc = self.joint_encoder(inp)
+        return self._decode(x_enc, x)
+
+    def _cat(self, tensors):
+        if torch.is_grad_enabled():
+            # out= variants do not support autograd
+            return torch.cat(tensors, dim=-1)
+        key = (
+            tensors[0].shape[0],
+            sum(t.shape[-1] for t in tensors),
+            tensors[0].dtype,
+            tensors[0].device,
+            torch.is_inference_mode_enabled(),
+        )
+        if key not in self._buf:
+            # a new shape invalidates the previous buffer
+            self._buf.clear()
+            self._buf[key] = torch.empty(
+                key[:2], dtype=key[2], device=key[3]
+            )
+        return torch.cat(tensors, dim=-1, out=self._buf[key])
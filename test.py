@@ -1,10 +1,23 @@
+import time
+
 import torch
 
 from lib.models.siren import GeoSIREN
 
 if __name__ == '__main__':
-    input_data = torch.randn(16, 3)  # Example input
-    z = torch.randn(16, 1)  # Latent code for conditioning
+    torch.manual_seed(0)
+    input_data = torch.randn(16, 1024, 3, device='cpu')  # Example input: 16 sets of 1024 points
+    z = torch.randn(16, 1, device='cpu')  # Latent code for conditioning
     geo_siren = GeoSIREN(input_dim=3, z_dim=1, hidden_dim=128, output_dim=3, device='cpu')
-    output = geo_siren(input_data, z)
-    print(output.shape)  # Should be (batch_size, 3)
+    geo_siren = torch.compile(geo_siren)
+    # no autograd tape is needed for a shape check
+    with torch.inference_mode():
+        start = time.perf_counter()
+        output = geo_siren(input_data, z)
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(10):
+            output = geo_siren(input_data, z)
+        steady = (time.perf_counter() - start) / 10
+    # Should be (batch_size, num_points, 3)
+    print(f'{tuple(output.shape)} first call {first * 1e3:.1f} ms, steady {steady * 1e3:.2f} ms')